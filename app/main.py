@@ -1,12 +1,39 @@
+from __future__ import annotations
+
 import os
 import asyncio
+import atexit
+import functools
+import hmac
 import logging
+import logging.handlers
 import json
-from typing import Any, Dict, List
+import queue
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, TypeVar
 from datetime import datetime, timezone
+from decimal import ROUND_HALF_EVEN, Decimal, InvalidOperation
 
 import httpx
+import ijson  # type: ignore[import-untyped]
+import uvicorn
 from dotenv import load_dotenv
+from fastapi import FastAPI, Header, HTTPException
+from pydantic import BaseModel
+
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    _loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:  # stdlib fallback when the wheel is unavailable
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+    _loads = json.loads
 
 load_dotenv()
 
@@ -31,136 +58,679 @@ def _normalize_service_url(val: str | None, kind: str) -> str:
     # Fallback: assume direct service defaults
     return default
 
+# Amounts are handled as integer atomic units (piconero); XMR floats only exist at service boundaries
+ATOMIC_PER_XMR = 10**12
+
+
+def _to_atomic(xmr: Any) -> int:
+    # Raises ValueError for anything that is not a finite XMR amount
+    if isinstance(xmr, bool):
+        raise ValueError(f"invalid XMR amount: {xmr!r}")
+    try:
+        return int((Decimal(str(xmr).strip()) * ATOMIC_PER_XMR).to_integral_value(ROUND_HALF_EVEN))
+    except (InvalidOperation, OverflowError, TypeError) as e:
+        raise ValueError(f"invalid XMR amount: {xmr!r}") from e
+
+
+def _parse_atomic(val: Any) -> int:
+    if isinstance(val, bool) or not isinstance(val, (int, str)):
+        raise ValueError(f"invalid atomic amount: {val!r}")
+    return int(val)
+
+
+def _to_xmr(atomic: int) -> float:
+    return atomic / ATOMIC_PER_XMR
+
+
 MONERO_BASE = _normalize_service_url(os.getenv("MONERO_SERVICE_URL"), "monero")
 TX_BASE = _normalize_service_url(os.getenv("TRANSACTIONS_SERVICE_URL"), "transactions")
+# Optional push endpoint; when enabled, polling only serves as a low-frequency backstop
+WEBHOOK_PORT = int(os.getenv("SWEEPER_WEBHOOK_PORT", "0"))
+WEBHOOK_HOST = os.getenv("SWEEPER_WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_TOKEN = os.getenv("SWEEPER_WEBHOOK_TOKEN") or ""
+if WEBHOOK_PORT and not WEBHOOK_TOKEN:
+    raise ValueError("SWEEPER_WEBHOOK_TOKEN is required when SWEEPER_WEBHOOK_PORT is set")
 SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL_SECONDS", "1800"))
-MIN_SWEEP_XMR = float(os.getenv("MIN_SWEEP_XMR", "0.0001"))
+MIN_SWEEP_INTERVAL = int(os.getenv("SWEEP_MIN_INTERVAL_SECONDS", str(min(300, SWEEP_INTERVAL))))
+MAX_SWEEP_INTERVAL = max(MIN_SWEEP_INTERVAL, int(os.getenv("SWEEP_MAX_INTERVAL_SECONDS", "21600" if WEBHOOK_PORT else str(SWEEP_INTERVAL))))
+MIN_SWEEP_ATOMIC = _to_atomic(os.getenv("MIN_SWEEP_XMR", "0.0001"))
+if MIN_SWEEP_ATOMIC < 0:
+    raise ValueError("MIN_SWEEP_XMR must not be negative")
+SWEEP_CONCURRENCY = max(1, int(os.getenv("SWEEP_CONCURRENCY", "16")))
+CREDIT_BATCH_SIZE = max(1, int(os.getenv("CREDIT_BATCH_SIZE", "256")))
 TARGET_SWEEP_ADDRESS = os.getenv("TARGET_SWEEP_ADDRESS")
+PRIMARY_TTL = int(os.getenv("PRIMARY_TTL", "3600"))
+# Must exceed the poll interval to ever hit between scheduled cycles; default covers the fastest schedule
+BALANCE_TTL = int(os.getenv("BALANCE_TTL", str(2 * MIN_SWEEP_INTERVAL)))
+SWEEP_STATE_PATH = os.getenv("SWEEP_STATE_PATH", "/var/lib/sweeper/state.json")
+# Incoming outputs stay locked for 10 blocks, so re-scan a window behind the last seen height
+SWEEP_LOOKBACK_BLOCKS = int(os.getenv("SWEEP_LOOKBACK_BLOCKS", "30"))
+FULL_SCAN_INTERVAL = int(os.getenv("SWEEP_FULL_SCAN_SECONDS", "86400"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 logger = logging.getLogger("pupero_sweeper")
 if not logger.handlers:
     h = logging.StreamHandler()
     logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
-    logger.addHandler(h)
+    # Stream writes happen on the listener thread so the event loop never blocks on stdout
+    _log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_queue, h)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+
+def jlog(level: int, event: str, **fields: Any) -> None:
+    if logger.isEnabledFor(level):
+        logger.log(level, _dumps({"event": event, **fields}))
+
+
+def _json(r: httpx.Response) -> Any:
+    return _loads(r.content)
+
+
+def build_client() -> httpx.AsyncClient:
+    # Connection-level failures are retried by the transport itself
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=300),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(30.0, connect=5.0))
+
+
+T = TypeVar("T")
+
+
+async def _with_backoff(coro_fn: Callable[[], Awaitable[T]], attempts: int = 3) -> T:
+    # Application-level retry with jittered exponential backoff, e.g. while a service is starting up
+    for i in range(attempts - 1):
+        try:
+            return await coro_fn()
+        except Exception:
+            await asyncio.sleep(min(2 ** i, 8) * (0.5 + random.random()))
+    return await coro_fn()
 
 
 async def get_primary_address(client: httpx.AsyncClient) -> str:
     url = f"{MONERO_BASE}/primary_address"
-    last_err = None
-    for attempt in range(3):
-        try:
-            r = await client.get(url, timeout=20.0)
-            r.raise_for_status()
-            data = r.json()
-            addr = data.get("address")
-            if not addr:
-                raise RuntimeError("primary_address returned no address")
-            return addr
-        except Exception as e:
-            last_err = e
-            # small backoff to allow services to come up
-            await asyncio.sleep(1.0)
-    raise RuntimeError(str(last_err) if last_err else "failed to fetch primary_address")
+    r = await client.get(url, timeout=20.0)
+    r.raise_for_status()
+    data = _json(r)
+    addr: str = data.get("address") or ""
+    if not addr:
+        raise RuntimeError("primary_address returned no address")
+    return addr
+
+
+# (address, fetched_at) of the last primary address lookup
+_PRIMARY_CACHE: tuple[str, float] | None = None
+
+
+async def resolve_sweep_target(client: httpx.AsyncClient) -> str:
+    global _PRIMARY_CACHE
+    if TARGET_SWEEP_ADDRESS:
+        return TARGET_SWEEP_ADDRESS
+    now = time.monotonic()
+    if _PRIMARY_CACHE is not None and now - _PRIMARY_CACHE[1] < PRIMARY_TTL:
+        return _PRIMARY_CACHE[0]
+    addr = await _with_backoff(lambda: get_primary_address(client))
+    _PRIMARY_CACHE = (addr, now)
+    return addr
+
+
+def invalidate_primary_cache() -> None:
+    global _PRIMARY_CACHE
+    _PRIMARY_CACHE = None
 
 
 async def list_address_mappings(client: httpx.AsyncClient) -> List[Dict[str, Any]]:
     url = f"{MONERO_BASE}/addresses"
     r = await client.get(url, timeout=20.0)
     r.raise_for_status()
-    return r.json() or []
+    return [m for m in _json(r) or [] if isinstance(m, dict)]
+
+
+class _StreamReader:
+    # Minimal async file-like adapter so ijson can consume an httpx byte stream
+    def __init__(self, chunks: AsyncIterator[bytes]) -> None:
+        self._chunks = chunks
+
+    async def read(self, n: int = -1) -> bytes:
+        # ijson probes with read(0) to detect bytes vs str; that must not consume a chunk
+        if n == 0:
+            return b""
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
 
 
-async def get_unlocked_xmr(client: httpx.AsyncClient, address: str) -> float:
+async def iter_address_mappings(client: httpx.AsyncClient) -> AsyncIterator[Dict[str, Any]]:
+    # Parse the mapping list as it arrives instead of buffering the whole payload.
+    # Falls back to a buffered GET if streaming fails before any mapping was produced
+    url = f"{MONERO_BASE}/addresses"
+    yielded = False
+    try:
+        async with client.stream("GET", url, timeout=20.0) as r:
+            r.raise_for_status()
+            async for m in ijson.items_async(_StreamReader(r.aiter_bytes()), "item", use_float=True):
+                if isinstance(m, dict):
+                    yielded = True
+                    yield m
+        return
+    except httpx.HTTPStatusError:
+        raise
+    except Exception as e:
+        if yielded:
+            raise
+        jlog(logging.WARNING, "address_stream_error", error=str(e))
+    for m in await list_address_mappings(client):
+        yield m
+
+
+async def get_incoming_transfers(client: httpx.AsyncClient, min_height: int) -> List[Dict[str, Any]] | None:
+    # Returns None when the wallet service does not expose /incoming_transfers
+    url = f"{MONERO_BASE}/incoming_transfers"
+    r = await client.get(url, params={"min_height": min_height}, timeout=30.0)
+    if r.status_code in (404, 405):
+        return None
+    r.raise_for_status()
+    return _json(r) or []
+
+
+def _unlocked_atomic(data: Any) -> int:
+    # Prefer the exact atomic amount when the wallet service provides it. A null or missing
+    # amount is unknown, not zero, so it raises ValueError like any other malformed value
+    if isinstance(data, dict):
+        if "unlocked_atomic" in data:
+            return _parse_atomic(data["unlocked_atomic"])
+        return _to_atomic(data.get("unlocked_balance_xmr"))
+    return _to_atomic(data)
+
+
+async def get_unlocked_atomic(client: httpx.AsyncClient, address: str) -> int:
     url = f"{MONERO_BASE}/balance/{address}"
     r = await client.get(url, timeout=30.0)
     r.raise_for_status()
-    data = r.json() or {}
-    return float(data.get("unlocked_balance_xmr", 0.0))
+    return _unlocked_atomic(_json(r))
+
+
+async def get_unlocked_balances(client: httpx.AsyncClient, addresses: List[str]) -> Dict[str, int] | None:
+    # Batch lookup; returns None when the wallet service does not expose /balances
+    url = f"{MONERO_BASE}/balances"
+    r = await client.post(url, json={"addresses": addresses}, timeout=60.0)
+    if r.status_code in (404, 405):
+        return None
+    r.raise_for_status()
+    data = _json(r) or {}
+    balances: Dict[str, int] = {}
+    for addr, val in data.items():
+        try:
+            balances[addr] = _unlocked_atomic(val)
+        except ValueError as e:
+            # Left out so the address falls back to its own /balance lookup
+            jlog(logging.WARNING, "batch_balance_parse_error", address=addr, error=str(e))
+    return balances
 
 
-async def sweep_from_address(client: httpx.AsyncClient, from_address: str, to_address: str) -> float:
+async def sweep_from_address(client: httpx.AsyncClient, from_address: str, to_address: str) -> int:
     url = f"{MONERO_BASE}/sweep_all"
     payload = {"from_address": from_address, "to_address": to_address}
     r = await client.post(url, json=payload, timeout=60.0)
     r.raise_for_status()
-    data = r.json() or {}
-    total = float(data.get("total_xmr", 0.0))
-    return total
+    # Past this point the sweep succeeded; null, missing or unparseable totals raise ValueError
+    # so they are not lost
+    data = _json(r)
+    if not isinstance(data, dict):
+        raise ValueError(f"unexpected sweep_all response: {data!r}")
+    if "total_atomic" in data:
+        return _parse_atomic(data["total_atomic"])
+    return _to_atomic(data.get("total_xmr"))
 
 
-async def credit_real_funds(client: httpx.AsyncClient, user_id: int, amount_xmr: float) -> None:
-    if amount_xmr <= 0:
+async def credit_real_funds(client: httpx.AsyncClient, user_id: int, amount_atomic: int) -> None:
+    if amount_atomic <= 0:
         return
     url = f"{TX_BASE}/balance/{user_id}/increase"
-    payload = {"amount_xmr": amount_xmr, "kind": "real"}
+    payload = {"amount_xmr": _to_xmr(amount_atomic), "kind": "real"}
     r = await client.post(url, json=payload, timeout=20.0)
     r.raise_for_status()
 
 
-async def sweep_cycle():
-    async with httpx.AsyncClient() as client:
+# Flipped off for the rest of the process once the Transactions service reports no bulk endpoint
+_BULK_CREDIT_SUPPORTED = True
+
+
+async def credit_real_funds_bulk(client: httpx.AsyncClient, credits: List[tuple[int, int]]) -> bool:
+    # One request for many (user_id, amount_atomic) credits; False when the endpoint does not exist
+    url = f"{TX_BASE}/balance/bulk_increase"
+    payload = [{"user_id": uid, "amount_xmr": _to_xmr(amt), "kind": "real"} for uid, amt in credits]
+    r = await client.post(url, json=payload, timeout=30.0)
+    if r.status_code in (404, 405):
+        return False
+    r.raise_for_status()
+    return True
+
+
+# address -> (unlocked_atomic, observed_at); only below-threshold balances are served from here
+_BAL_CACHE: dict[str, tuple[int, float]] = {}
+
+
+def _cached_negative(addr: str, now: float) -> int | None:
+    entry = _BAL_CACHE.get(addr)
+    if entry is None:
+        return None
+    bal, ts = entry
+    if now - ts >= BALANCE_TTL or bal >= MIN_SWEEP_ATOMIC:
+        _BAL_CACHE.pop(addr, None)
+        return None
+    return bal
+
+
+# Addresses swept in the previous cycle; scheduled first since deposits tend to cluster
+_HOT: set[str] = set()
+
+
+def _load_state() -> Dict[str, Any]:
+    try:
+        with open(SWEEP_STATE_PATH, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        jlog(logging.WARNING, "state_load_error", path=SWEEP_STATE_PATH, error=str(e))
+        return {}
+    if not isinstance(state, dict):
+        jlog(logging.WARNING, "state_load_error", path=SWEEP_STATE_PATH, error="state is not an object")
+        return {}
+    # Drop malformed fields so the next cycle falls back to a full scan instead of failing
+    for key in ("last_height", "last_full_scan"):
+        val = state.get(key)
+        if val is not None and (isinstance(val, bool) or not isinstance(val, (int, float))):
+            jlog(logging.WARNING, "state_load_error", path=SWEEP_STATE_PATH, error=f"invalid {key}")
+            state.pop(key)
+    retry = state.get("retry")
+    if retry is not None and (not isinstance(retry, list) or not all(isinstance(a, str) for a in retry)):
+        jlog(logging.WARNING, "state_load_error", path=SWEEP_STATE_PATH, error="invalid retry")
+        state.pop("retry")
+    return state
+
+
+def _save_state(state: Dict[str, Any]) -> None:
+    try:
+        os.makedirs(os.path.dirname(SWEEP_STATE_PATH) or ".", exist_ok=True)
+        tmp = f"{SWEEP_STATE_PATH}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, SWEEP_STATE_PATH)
+    except Exception as e:
+        jlog(logging.WARNING, "state_save_error", path=SWEEP_STATE_PATH, error=str(e))
+
+
+async def _dirty_addresses(client: httpx.AsyncClient, state: Dict[str, Any]) -> set[str] | None:
+    # Addresses that received transfers since the last tracked height, plus those whose balance
+    # lookup or sweep failed last cycle; updates state in place.
+    # None means every mapping must be checked (first run, full scan due, or endpoint unavailable)
+    last_height = state.get("last_height")
+    min_height = 0 if last_height is None else max(0, int(last_height) - SWEEP_LOOKBACK_BLOCKS)
+    try:
+        transfers = await get_incoming_transfers(client, min_height)
+        if transfers is None:
+            return None
+        if not isinstance(transfers, list) or not all(isinstance(t, dict) for t in transfers):
+            raise ValueError("incoming_transfers did not return a list of transfers")
+        heights = [int(t.get("height") or 0) for t in transfers]
+        dirty = {str(t["address"]) for t in transfers if t.get("address")}
+    except Exception as e:
+        jlog(logging.WARNING, "incoming_transfers_error", error=str(e))
+        return None
+    state["last_height"] = max([int(last_height or 0), *heights])
+    now = time.time()
+    if last_height is None or now - float(state.get("last_full_scan", 0)) >= FULL_SCAN_INTERVAL:
+        state["last_full_scan"] = now
+        return None
+    # last_height has already moved past these deposits, so they are only seen again from here
+    return dirty | set(state.get("retry", []))
+
+
+def _log_address_error(addr: str | None, e: Exception) -> None:
+    if isinstance(e, httpx.HTTPStatusError):
+        # The wallet may have been rotated; re-resolve the primary address next cycle
+        invalidate_primary_cache()
+        jlog(logging.WARNING, "address_process_http_error", address=addr, status=e.response.status_code if e.response else None)
+    else:
+        jlog(logging.WARNING, "address_process_error", address=addr, error=str(e))
+
+
+async def _fetch_balance(client: httpx.AsyncClient, sem: asyncio.Semaphore, addr: str) -> int | None:
+    async with sem:
         try:
-            target = TARGET_SWEEP_ADDRESS or await get_primary_address(client)
+            return await get_unlocked_atomic(client, addr)
         except Exception as e:
-            logger.error(json.dumps({"event": "sweep_target_error", "error": str(e)}))
-            return
+            _log_address_error(addr, e)
+            return None
+
+
+async def _sweep_one(client: httpx.AsyncClient, sem: asyncio.Semaphore, user_id: int, addr: str, target: str) -> int | None:
+    # None when the sweep failed and the address should be retried
+    async with sem:
         try:
-            mappings = await list_address_mappings(client)
+            return await sweep_from_address(client, addr, target)
+        except ValueError as e:
+            # sweep_all returned 2xx but the amount is unreadable: funds may have moved uncredited,
+            # so log enough to reconcile by hand
+            jlog(logging.ERROR, "credit_error", user_id=user_id, **{"from": addr}, to=target, amount_xmr=None, error=str(e))
+            return 0
         except Exception as e:
-            logger.error(json.dumps({"event": "list_addresses_error", "error": str(e)}))
-            return
-        summary = {"checked": 0, "swept": 0, "credited": 0.0}
-        for m in mappings:
-            try:
-                addr = m.get("address")
-                user_id = int(m.get("user_id"))
-                if not addr or not user_id:
-                    continue
-                if addr == target:
-                    # Avoid sweeping the target itself
-                    continue
-                summary["checked"] += 1
-                unlocked = await get_unlocked_xmr(client, addr)
-                if unlocked >= MIN_SWEEP_XMR:
-                    swept = await sweep_from_address(client, addr, target)
-                    if swept > 0:
-                        await credit_real_funds(client, user_id, swept)
-                        summary["swept"] += 1
-                        summary["credited"] += swept
-                        logger.info(json.dumps({"event": "swept_and_credited", "user_id": user_id, "from": addr, "to": target, "amount_xmr": swept}))
-                # If this address is disabled and past deletion_date and now empty, delete mapping
-                try:
-                    is_disabled = bool(m.get("is_disabled", False))
-                    deletion_date = m.get("deletion_date")
-                    addr_id = m.get("id")
-                    if is_disabled and deletion_date and addr_id and unlocked < MIN_SWEEP_XMR:
-                        # Parse ISO date; handle possible 'Z' suffix
-                        try:
-                            cutoff = datetime.fromisoformat(str(deletion_date).replace("Z", "+00:00"))
-                        except Exception:
-                            cutoff = None
-                        if cutoff and datetime.now(timezone.utc) >= cutoff.replace(tzinfo=timezone.utc):
-                            dr = await client.delete(f"{MONERO_BASE}/addresses/{addr_id}", timeout=15.0)
-                            if dr.status_code in (200, 204):
-                                logger.info(json.dumps({"event": "address_deleted", "address_id": addr_id, "address": addr, "user_id": user_id}))
-                except Exception as e:
-                    logger.warning(json.dumps({"event": "address_delete_check_failed", "address": addr, "error": str(e)}))
-            except httpx.HTTPStatusError as e:
-                logger.warning(json.dumps({"event": "address_process_http_error", "address": m.get("address"), "status": e.response.status_code if e.response else None}))
-            except Exception as e:
-                logger.warning(json.dumps({"event": "address_process_error", "address": m.get("address"), "error": str(e)}))
-        logger.info(json.dumps({"event": "sweep_cycle_summary", **summary}))
+            _log_address_error(addr, e)
+            return None
+
+
+async def _sweep_indexed(client: httpx.AsyncClient, sem: asyncio.Semaphore, i: int, user_id: int, addr: str, target: str) -> tuple[int, int | None]:
+    return i, await _sweep_one(client, sem, user_id, addr, target)
+
+
+async def _credit_one(client: httpx.AsyncClient, sem: asyncio.Semaphore, user_id: int, addr: str, target: str, swept: int) -> bool:
+    async with sem:
+        try:
+            await credit_real_funds(client, user_id, swept)
+        except Exception as e:
+            # Funds already left the subaddress; log enough to reconcile by hand
+            jlog(logging.ERROR, "credit_error", user_id=user_id, **{"from": addr}, amount_xmr=_to_xmr(swept), error=str(e))
+            return False
+    jlog(logging.INFO, "swept_and_credited", user_id=user_id, **{"from": addr}, to=target, amount_xmr=_to_xmr(swept))
+    return True
+
+
+async def _credit_batch(client: httpx.AsyncClient, sem: asyncio.Semaphore, target: str, batch: List[tuple[int, str, int]]) -> List[bool]:
+    global _BULK_CREDIT_SUPPORTED
+    if not _BULK_CREDIT_SUPPORTED:
+        return list(await asyncio.gather(*[_credit_one(client, sem, uid, addr, target, amt) for uid, addr, amt in batch]))
+    async with sem:
+        try:
+            supported = await credit_real_funds_bulk(client, [(uid, amt) for uid, _, amt in batch])
+        except Exception as e:
+            # The batch may have been partially applied, so never replay it per user
+            for uid, addr, amt in batch:
+                jlog(logging.ERROR, "credit_error", user_id=uid, **{"from": addr}, amount_xmr=_to_xmr(amt), error=str(e))
+            return [False] * len(batch)
+    if not supported:
+        _BULK_CREDIT_SUPPORTED = False
+        jlog(logging.INFO, "bulk_credit_unsupported")
+        return list(await asyncio.gather(*[_credit_one(client, sem, uid, addr, target, amt) for uid, addr, amt in batch]))
+    for uid, addr, amt in batch:
+        jlog(logging.INFO, "swept_and_credited", user_id=uid, **{"from": addr}, to=target, amount_xmr=_to_xmr(amt))
+    return [True] * len(batch)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_cutoff(s: str) -> datetime | None:
+    # Parse ISO date; handle possible 'Z' suffix. Memoized since mappings repeat every cycle
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00")).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _coerce_id(raw: Any) -> int:
+    # Positive integer id from a JSON value, or 0 when missing/malformed
+    if isinstance(raw, bool):
+        return 0
+    if isinstance(raw, int):
+        return raw if raw > 0 else 0
+    if isinstance(raw, str) and raw.isascii() and raw.isdigit():
+        return int(raw)
+    return 0
+
+
+def _is_past(deletion_date: str | None, now: datetime) -> bool:
+    cutoff = _parse_cutoff(deletion_date) if deletion_date else None
+    return cutoff is not None and now >= cutoff
+
+
+async def _delete_one(client: httpx.AsyncClient, sem: asyncio.Semaphore, addr_id: int) -> bool:
+    async with sem:
+        try:
+            dr = await client.delete(f"{MONERO_BASE}/addresses/{addr_id}", timeout=15.0)
+        except Exception as e:
+            jlog(logging.WARNING, "address_delete_failed", address_id=addr_id, error=str(e))
+            return False
+    return dr.status_code in (200, 204)
+
 
+async def delete_address_mappings(client: httpx.AsyncClient, sem: asyncio.Semaphore, addr_ids: List[int]) -> List[int]:
+    # One batch request when the wallet service supports it, otherwise concurrent DELETEs.
+    # Returns the ids that were removed
+    try:
+        r = await client.post(f"{MONERO_BASE}/addresses/batch_delete", json={"ids": addr_ids}, timeout=30.0)
+        if r.status_code not in (404, 405):
+            r.raise_for_status()
+            return addr_ids
+    except Exception as e:
+        jlog(logging.WARNING, "batch_delete_error", error=str(e))
+    results = await asyncio.gather(*[_delete_one(client, sem, i) for i in addr_ids])
+    return [i for i, ok in zip(addr_ids, results) if ok]
+
+
+# Scheduled and webhook-triggered cycles must not sweep the same addresses concurrently
+_SWEEP_LOCK = asyncio.Lock()
+
+
+async def sweep_cycle(client: httpx.AsyncClient, addresses: set[str] | None = None) -> Dict[str, Any] | None:
+    # addresses restricts the cycle to the given subaddresses (webhook-triggered runs)
+    async with _SWEEP_LOCK:
+        return await _run_sweep_cycle(client, addresses)
+
+
+async def _run_sweep_cycle(client: httpx.AsyncClient, addresses: set[str] | None) -> Dict[str, Any] | None:
+    try:
+        target = await resolve_sweep_target(client)
+    except Exception as e:
+        jlog(logging.ERROR, "sweep_target_error", error=str(e))
+        return None
+    # Flatten the mapping dicts into parallel columns as they stream in; stages below work on indices
+    addrs: List[str] = []
+    uids: List[int] = []
+    disabled: List[bool] = []
+    del_dates: List[str | None] = []
+    ids: List[int] = []
+    try:
+        async for m in iter_address_mappings(client):
+            addrs.append(a if isinstance(a := m.get("address"), str) else "")
+            uids.append(_coerce_id(m.get("user_id")))
+            disabled.append(bool(m.get("is_disabled")))
+            del_dates.append(d if isinstance(d := m.get("deletion_date"), str) else None)
+            ids.append(_coerce_id(m.get("id")))
+    except Exception as e:
+        jlog(logging.ERROR, "list_addresses_error", error=str(e))
+        return None
+    # Skip incomplete mappings and the target itself
+    idx = [i for i, a in enumerate(addrs) if a and uids[i] and a != target]
+    # Only addresses with recent incoming transfers can have new funds; disabled mappings
+    # awaiting deletion are always kept so their cleanup is not starved
+    state: Dict[str, Any] | None = None
+    if addresses is not None:
+        # Pushed by the wallet service, which already knows which addresses changed
+        dirty: set[str] | None = addresses
+    else:
+        state = _load_state()
+        dirty = await _dirty_addresses(client, state)
+    if dirty is not None:
+        idx = [i for i in idx if addrs[i] in dirty or (disabled[i] and del_dates[i])]
+    if _HOT:
+        idx.sort(key=lambda i: addrs[i] not in _HOT)
+    summary: Dict[str, Any] = {"checked": len(idx), "swept": 0, "credited": 0.0}
+    credited_atomic = 0
+    # sem bounds wallet-RPC calls only. Credits go to the Transactions service and mapping cleanup
+    # is a plain DB call, so each gets its own limit instead of queueing behind pending sweeps
+    sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    tx_sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    delete_sem = asyncio.Semaphore(SWEEP_CONCURRENCY)
+
+    # Stage 1: balances. Recent below-threshold results are reused unless new transfers arrived,
+    # the rest come from one batched call plus per-address lookups for anything it did not cover
+    now = time.monotonic()
+    # Deleting a mapping is irreversible, so expired ones always get a fresh balance
+    utc_now = datetime.now(timezone.utc)
+    expired = {i for i in idx if disabled[i] and del_dates[i] and ids[i] and _is_past(del_dates[i], utc_now)}
+    balances: Dict[str, int] = {}
+    lookup: List[str] = []
+    for i in idx:
+        addr = addrs[i]
+        if (dirty is not None and addr in dirty) or i in expired:
+            _BAL_CACHE.pop(addr, None)
+        cached = _cached_negative(addr, now)
+        if cached is None:
+            lookup.append(addr)
+        else:
+            balances[addr] = cached
+    fetched_batch: Dict[str, int] = {}
+    if lookup:
+        try:
+            fetched_batch = await get_unlocked_balances(client, lookup) or {}
+        except Exception as e:
+            jlog(logging.WARNING, "batch_balance_error", error=str(e))
+    missing = [addr for addr in lookup if addr not in fetched_batch]
+    if missing:
+        fetched = await asyncio.gather(*[_fetch_balance(client, sem, addr) for addr in missing])
+        fetched_batch.update({addr: bal for addr, bal in zip(missing, fetched) if bal is not None})
+    for addr in lookup:
+        if addr in fetched_batch:
+            balances[addr] = fetched_batch[addr]
+            _BAL_CACHE[addr] = (fetched_batch[addr], now)
+
+    # Disabled mappings past their deletion_date are removed once empty; this only depends on
+    # stage 1, so it runs in the background alongside the sweeps
+    to_delete = [i for i in idx if i in expired and addrs[i] in fetched_batch and fetched_batch[addrs[i]] < MIN_SWEEP_ATOMIC]
+    delete_task = asyncio.create_task(delete_address_mappings(client, delete_sem, [ids[i] for i in to_delete])) if to_delete else None
+
+    # Stages 2 and 3: sweep every address holding enough unlocked funds. Credits are submitted as
+    # background tasks while later sweeps are still in flight: a batch goes out as soon as no other
+    # credit request is pending (or it is full), so latency is hidden without giving up batching
+    to_sweep = [i for i in idx if addrs[i] in balances and balances[addrs[i]] >= MIN_SWEEP_ATOMIC]
+    credit_batches: List[List[tuple[int, str, int]]] = []
+    credit_tasks: List[asyncio.Task[List[bool]]] = []
+    pending: List[tuple[int, str, int]] = []
+    # Balance lookups and sweeps that failed are retried next cycle even without new transfers
+    failed = {addrs[i] for i in idx if addrs[i] not in balances}
+
+    def submit_credits() -> None:
+        credit_batches.append(list(pending))
+        credit_tasks.append(asyncio.create_task(_credit_batch(client, tx_sem, target, list(pending))))
+        pending.clear()
+
+    for fut in asyncio.as_completed([_sweep_indexed(client, sem, i, uids[i], addrs[i], target) for i in to_sweep]):
+        i, amt = await fut
+        if amt is None:
+            failed.add(addrs[i])
+            continue
+        if amt <= 0:
+            continue
+        _BAL_CACHE.pop(addrs[i], None)
+        pending.append((uids[i], addrs[i], amt))
+        if len(pending) >= CREDIT_BATCH_SIZE or all(t.done() for t in credit_tasks):
+            submit_credits()
+    if pending:
+        submit_credits()
 
-async def main_loop():
-    logger.info(json.dumps({"event": "sweeper_start", "interval_seconds": SWEEP_INTERVAL, "min_sweep_xmr": MIN_SWEEP_XMR}))
-    while True:
+    if addresses is None:
+        _HOT.clear()
+    for batch, res in zip(credit_batches, await asyncio.gather(*credit_tasks, return_exceptions=True)):
+        if isinstance(res, BaseException):
+            for uid, addr, amt in batch:
+                jlog(logging.ERROR, "credit_error", user_id=uid, **{"from": addr}, amount_xmr=_to_xmr(amt), error=str(res))
+            continue
+        for (_, addr, amt), ok in zip(batch, res):
+            if ok:
+                summary["swept"] += 1
+                credited_atomic += amt
+                _HOT.add(addr)
+    if delete_task is not None:
+        deleted = set(await delete_task)
+        for i in to_delete:
+            if ids[i] in deleted:
+                jlog(logging.INFO, "address_deleted", address_id=ids[i], address=addrs[i], user_id=uids[i])
+    summary["credited"] = _to_xmr(credited_atomic)
+    if state is not None:
+        state["retry"] = sorted(failed)
+        _save_state(state)
+    jlog(logging.INFO, "sweep_cycle_summary", **summary, full_scan=dirty is None, triggered=addresses is not None)
+    return summary
+
+
+def next_sweep_interval(current: float, summary: Dict[str, Any] | None) -> float:
+    # Poll faster while deposits keep arriving, back off toward the ceiling when idle
+    if summary is None:
+        return current
+    if summary.get("swept", 0) > 0:
+        return max(MIN_SWEEP_INTERVAL, current / 2)
+    return min(MAX_SWEEP_INTERVAL, current * 2)
+
+
+class WalletRefresh(BaseModel):
+    addresses: List[str] = []
+
+
+async def _drain_triggered(client: httpx.AsyncClient, pending: set[str]) -> None:
+    # Notifications that arrive while a triggered cycle runs are merged into the next one
+    while pending:
+        addresses = set(pending)
+        pending.clear()
         try:
-            await sweep_cycle()
+            await sweep_cycle(client, addresses=addresses)
         except Exception as e:
-            logger.error(json.dumps({"event": "sweep_cycle_exception", "error": str(e)}))
-        await asyncio.sleep(SWEEP_INTERVAL)
+            jlog(logging.ERROR, "sweep_cycle_exception", error=str(e), triggered=True)
+
+
+def build_webhook_app(client: httpx.AsyncClient) -> FastAPI:
+    app = FastAPI(title="Pupero Sweeper", docs_url=None, redoc_url=None, openapi_url=None)
+    # At most one drain task at a time; it also keeps the task referenced while it runs
+    pending: set[str] = set()
+    drain: List[asyncio.Task[None]] = []
+
+    @app.post("/webhooks/wallet_refresh", status_code=202)
+    async def wallet_refresh(payload: WalletRefresh, x_webhook_token: str | None = Header(default=None)) -> Dict[str, Any]:
+        if not hmac.compare_digest(x_webhook_token or "", WEBHOOK_TOKEN):
+            raise HTTPException(status_code=401, detail="Invalid webhook token")
+        addresses = {a for a in payload.addresses if a}
+        pending.update(addresses)
+        if pending and not (drain and not drain[0].done()):
+            drain[:] = [asyncio.create_task(_drain_triggered(client, pending))]
+        jlog(logging.INFO, "wallet_refresh_webhook", addresses=len(addresses), pending=len(pending))
+        return {"scheduled": len(addresses)}
+
+    return app
+
+
+def _on_webhook_server_done(task: asyncio.Task[None]) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        jlog(logging.ERROR, "webhook_server_stopped", error=str(task.exception()))
+
+
+async def main_loop() -> None:
+    jlog(logging.INFO, "sweeper_start", interval_seconds=SWEEP_INTERVAL, min_interval_seconds=MIN_SWEEP_INTERVAL, max_interval_seconds=MAX_SWEEP_INTERVAL, min_sweep_xmr=_to_xmr(MIN_SWEEP_ATOMIC), webhook_port=WEBHOOK_PORT or None)
+    interval = float(min(max(SWEEP_INTERVAL, MIN_SWEEP_INTERVAL), MAX_SWEEP_INTERVAL))
+    # One client for the process lifetime so keep-alive connections survive between cycles
+    async with build_client() as client:
+        server_task = None
+        if WEBHOOK_PORT:
+            config = uvicorn.Config(build_webhook_app(client), host=WEBHOOK_HOST, port=WEBHOOK_PORT, log_level=LOG_LEVEL.lower(), access_log=False)
+            server_task = asyncio.create_task(uvicorn.Server(config).serve())
+            server_task.add_done_callback(_on_webhook_server_done)
+        try:
+            while True:
+                summary = None
+                try:
+                    summary = await sweep_cycle(client)
+                except Exception as e:
+                    jlog(logging.ERROR, "sweep_cycle_exception", error=str(e))
+                interval = next_sweep_interval(interval, summary)
+                jlog(logging.DEBUG, "next_sweep_scheduled", interval_seconds=interval)
+                await asyncio.sleep(interval)
+        finally:
+            if server_task is not None:
+                server_task.cancel()
 
 
 if __name__ == "__main__":